@@ -1,12 +1,17 @@
+import asyncio
+import base64
+import heapq
 import os
 import secrets
-from datetime import datetime, timedelta
-from typing import Optional
+import time
+from typing import Optional, Tuple
 import httpx
-from fastapi import HTTPException, Security, status
+from fastapi import HTTPException, Request, Security, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from dotenv import load_dotenv
 
+import redis.asyncio as redis
+
 load_dotenv()
 
 # Medplum configuration
@@ -14,8 +19,30 @@ MEDPLUM_BASE_URL = os.getenv("MEDPLUM_BASE_URL", "https://api.medplum.com")
 MEDPLUM_CLIENT_ID = os.getenv("MEDPLUM_CLIENT_ID")
 MEDPLUM_CLIENT_SECRET = os.getenv("MEDPLUM_CLIENT_SECRET")
 
-# In-memory token store for our server's OAuth2
+# Optional shared store so all workers accept the same client tokens and
+# reuse one Medplum token; without it both live in this process only
+REDIS_URL = os.getenv("REDIS_URL")
+CLIENT_TOKEN_KEY_PREFIX = "emr:client_token:"
+MEDPLUM_TOKEN_KEY = "medplum:token"
+MEDPLUM_TOKEN_LOCK_KEY = "medplum:token:lock"
+TOKEN_LOCK_TIMEOUT = 10  # seconds a worker may hold the refresh lock
+TOKEN_POLL_INTERVAL = 0.1  # seconds between checks while another worker refreshes
+# Delete the refresh lock only if it still holds our value; a refresh that
+# outlives TOKEN_LOCK_TIMEOUT must not release another worker's lock
+RELEASE_TOKEN_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# In-memory token store for our server's OAuth2 when Redis is not
+# configured: token -> expires_at
 token_store = {}
+# Min-heap of (expires_at, token) so the sweeper only visits expired tokens
+token_expiry_heap = []
+TOKEN_LIFETIME = 86400  # 24 hours
+TOKEN_SWEEP_INTERVAL = 60  # seconds
 
 security = HTTPBearer()
 
@@ -23,77 +50,185 @@ security = HTTPBearer()
 class MedplumAuth:
     """Handles authentication with Medplum FHIR server"""
     
-    def __init__(self):
+    __slots__ = ("access_token", "token_expiry", "redis", "_token_headers", "_token_body")
+    
+    def __init__(self, redis_client=None):
         self.access_token: Optional[str] = None
-        self.token_expiry: Optional[datetime] = None
+        self.token_expiry: Optional[float] = None  # time.monotonic() deadline
+        # Shared token cache; None keeps the token in this process only
+        self.redis = redis_client
+        # Client credentials are fixed at startup, so build the request once
+        credentials = f"{MEDPLUM_CLIENT_ID}:{MEDPLUM_CLIENT_SECRET}"
+        self._token_headers = {
+            "Authorization": f"Basic {base64.b64encode(credentials.encode()).decode()}",
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+        self._token_body = b"grant_type=client_credentials"
     
-    async def get_access_token(self) -> str:
+    async def get_access_token(self, client: httpx.AsyncClient) -> str:
         """Get valid access token for Medplum, refresh if needed"""
-        if self.access_token and self.token_expiry and datetime.now() < self.token_expiry:
+        if self.access_token and self.token_expiry and time.monotonic() < self.token_expiry:
             return self.access_token
         
-        # Request new token from Medplum using Basic Auth
-        import base64
-        credentials = f"{MEDPLUM_CLIENT_ID}:{MEDPLUM_CLIENT_SECRET}"
-        basic_auth = base64.b64encode(credentials.encode()).decode()
+        if self.redis is None:
+            token, lifetime = await self._request_token(client)
+            self._store_local_token(token, lifetime)
+            return token
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.medplum.com/oauth2/token",
-                headers={
-                    "Authorization": f"Basic {basic_auth}",
-                    "Content-Type": "application/x-www-form-urlencoded"
-                },
-                data="grant_type=client_credentials"
-            )
-            
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"Failed to authenticate with Medplum: {response.text}"
-                )
+        return await self._get_shared_token(client)
+    
+    async def _get_shared_token(self, client: httpx.AsyncClient) -> str:
+        """Get token from Redis, letting only one worker refresh it on expiry"""
+        deadline = time.monotonic() + TOKEN_LOCK_TIMEOUT
+        
+        while time.monotonic() < deadline:
+            if await self._load_shared_token():
+                return self.access_token
             
-            token_data = response.json()
-            self.access_token = token_data["access_token"]
-            # Set expiry with 5 minute buffer
-            expires_in = token_data.get("expires_in", 3600)
-            self.token_expiry = datetime.now() + timedelta(seconds=expires_in - 300)
+            lock_value = secrets.token_hex(16)
+            if await self.redis.set(MEDPLUM_TOKEN_LOCK_KEY, lock_value, nx=True, ex=TOKEN_LOCK_TIMEOUT):
+                try:
+                    # The previous holder may have published just before we
+                    # won the lock
+                    if await self._load_shared_token():
+                        return self.access_token
+                    token, lifetime = await self._request_token(client)
+                    await self.redis.set(MEDPLUM_TOKEN_KEY, token, ex=max(lifetime, 1))
+                finally:
+                    await self.redis.eval(
+                        RELEASE_TOKEN_LOCK_SCRIPT, 1, MEDPLUM_TOKEN_LOCK_KEY, lock_value
+                    )
+                self._store_local_token(token, lifetime)
+                return token
             
-            return self.access_token
+            # Another worker is refreshing; wait for it to publish the token
+            await asyncio.sleep(TOKEN_POLL_INTERVAL)
+        
+        # Lock holder never published a token, so fetch one ourselves
+        token, lifetime = await self._request_token(client)
+        self._store_local_token(token, lifetime)
+        return token
+    
+    async def _load_shared_token(self) -> bool:
+        """Copy a still-valid token from Redis into this instance"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            token, ttl = await pipe.get(MEDPLUM_TOKEN_KEY).ttl(MEDPLUM_TOKEN_KEY).execute()
+        
+        if not token or ttl <= 0:
+            return False
+        
+        self._store_local_token(token, ttl)
+        return True
+    
+    def _store_local_token(self, token: str, lifetime: int):
+        """Cache token in this process for lifetime seconds"""
+        self.access_token = token
+        self.token_expiry = time.monotonic() + lifetime
+    
+    async def _request_token(self, client: httpx.AsyncClient) -> Tuple[str, int]:
+        """Request new token from Medplum, returning it with its usable lifetime in seconds"""
+        # Request new token from Medplum using Basic Auth
+        response = await client.post(
+            "https://api.medplum.com/oauth2/token",
+            headers=self._token_headers,
+            content=self._token_body
+        )
+        
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Failed to authenticate with Medplum: {response.text}"
+            )
+        
+        token_data = response.json()
+        # Set expiry with 5 minute buffer
+        expires_in = token_data.get("expires_in", 3600)
+        return token_data["access_token"], expires_in - 300
 
 
 # Global Medplum auth instance
 medplum_auth = MedplumAuth()
 
+# Shared Redis connection, set by init_redis() when REDIS_URL is configured
+redis_client = None
+
+
+def init_redis() -> bool:
+    """Connect to Redis if REDIS_URL is set, returning whether tokens are shared"""
+    global redis_client
+    if not REDIS_URL:
+        return False
+    redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+    medplum_auth.redis = redis_client
+    return True
+
+
+async def close_redis():
+    """Close the shared Redis connection, if any"""
+    global redis_client
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+        medplum_auth.redis = None
+
 
-def create_access_token() -> str:
+async def create_access_token() -> str:
     """Create a new access token for clients accessing our server"""
     token = secrets.token_urlsafe(32)
-    token_store[token] = {
-        "created_at": datetime.now(),
-        "expires_at": datetime.now() + timedelta(hours=24)
-    }
+    
+    if redis_client is not None:
+        # Redis expires the key itself, so no sweeping is needed
+        await redis_client.set(CLIENT_TOKEN_KEY_PREFIX + token, 1, ex=TOKEN_LIFETIME)
+        return token
+    
+    expires_at = time.monotonic() + TOKEN_LIFETIME
+    token_store[token] = expires_at
+    heapq.heappush(token_expiry_heap, (expires_at, token))
     return token
 
 
-def validate_token(token: str) -> bool:
+async def validate_token(token: str) -> bool:
     """Validate if token exists and is not expired"""
-    if token not in token_store:
+    if redis_client is not None:
+        return bool(await redis_client.exists(CLIENT_TOKEN_KEY_PREFIX + token))
+    
+    expires_at = token_store.get(token)
+    if expires_at is None:
         return False
     
-    token_data = token_store[token]
-    if datetime.now() > token_data["expires_at"]:
+    if time.monotonic() > expires_at:
         del token_store[token]
         return False
     
     return True
 
 
+def sweep_expired_tokens() -> int:
+    """Remove expired tokens from token_store, returning how many were removed"""
+    now = time.monotonic()
+    removed = 0
+    
+    while token_expiry_heap and token_expiry_heap[0][0] < now:
+        _, token = heapq.heappop(token_expiry_heap)
+        # Token may already be gone if validate_token saw it expire
+        if token_store.pop(token, None) is not None:
+            removed += 1
+    
+    return removed
+
+
+async def run_token_sweeper():
+    """Background task that periodically evicts expired tokens"""
+    while True:
+        await asyncio.sleep(TOKEN_SWEEP_INTERVAL)
+        sweep_expired_tokens()
+
+
 async def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)) -> str:
     """FastAPI dependency to verify bearer token"""
     token = credentials.credentials
     
-    if not validate_token(token):
+    if not await validate_token(token):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired token",
@@ -103,6 +238,6 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Security(secu
     return token
 
 
-async def get_medplum_token() -> str:
+async def get_medplum_token(request: Request) -> str:
     """Dependency to get valid Medplum access token"""
-    return await medplum_auth.get_access_token()
\ No newline at end of file
+    return await medplum_auth.get_access_token(request.app.state.http)
\ No newline at end of file
@@ -1,6 +1,6 @@
 import httpx
 from fastapi import APIRouter, Depends, HTTPException, Request, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from .auth import verify_token, get_medplum_token
 import os
 
@@ -9,25 +9,33 @@ MEDPLUM_BASE_URL = os.getenv("MEDPLUM_BASE_URL", "https://api.medplum.com/fhir/R
 router = APIRouter(prefix="/fhir", tags=["FHIR Proxy"])
 
 
-async def proxy_fhir_get(resource_type: str, query_params: str, medplum_token: str):
+def fhir_passthrough(response: httpx.Response) -> Response:
+    """Return Medplum's JSON body as-is; the proxy performs no transformation"""
+    return Response(
+        content=response.content,
+        media_type="application/fhir+json",
+        status_code=response.status_code
+    )
+
+
+async def proxy_fhir_get(request: Request, resource_type: str, query_params: str, medplum_token: str):
     """Proxy GET request to Medplum FHIR API"""
-    url = f"{MEDPLUM_BASE_URL}/{resource_type}"
+    url = f"/{resource_type}"
     if query_params:
         url += f"?{query_params}"
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            url,
-            headers={"Authorization": f"Bearer {medplum_token}"}
+    response = await request.app.state.http.get(
+        url,
+        headers={"Authorization": f"Bearer {medplum_token}"}
+    )
+    
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Medplum API error: {response.text}"
         )
-        
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Medplum API error: {response.text}"
-            )
-        
-        return response.json()
+    
+    return fhir_passthrough(response)
 
 
 @router.get("/Patient")
@@ -38,33 +46,33 @@ async def get_patients(
 ):
     """Search for patients"""
     query_params = str(request.query_params)
-    return await proxy_fhir_get("Patient", query_params, medplum_token)
+    return await proxy_fhir_get(request, "Patient", query_params, medplum_token)
 
 
 @router.get("/Patient/{patient_id}")
 async def get_patient_by_id(
+    request: Request,
     patient_id: str,
     token: str = Depends(verify_token),
     medplum_token: str = Depends(get_medplum_token)
 ):
     """Get a specific patient by ID"""
-    url = f"{MEDPLUM_BASE_URL}/Patient/{patient_id}"
+    url = f"/Patient/{patient_id}"
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            url,
-            headers={"Authorization": f"Bearer {medplum_token}"}
+    response = await request.app.state.http.get(
+        url,
+        headers={"Authorization": f"Bearer {medplum_token}"}
+    )
+    
+    if response.status_code == 404:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    elif response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Medplum API error: {response.text}"
         )
-        
-        if response.status_code == 404:
-            raise HTTPException(status_code=404, detail="Patient not found")
-        elif response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Medplum API error: {response.text}"
-            )
-        
-        return response.json()
+    
+    return fhir_passthrough(response)
 
 
 @router.get("/Coverage")
@@ -75,33 +83,33 @@ async def get_coverages(
 ):
     """Search for coverage resources"""
     query_params = str(request.query_params)
-    return await proxy_fhir_get("Coverage", query_params, medplum_token)
+    return await proxy_fhir_get(request, "Coverage", query_params, medplum_token)
 
 
 @router.get("/Coverage/{coverage_id}")
 async def get_coverage_by_id(
+    request: Request,
     coverage_id: str,
     token: str = Depends(verify_token),
     medplum_token: str = Depends(get_medplum_token)
 ):
     """Get a specific coverage by ID"""
-    url = f"{MEDPLUM_BASE_URL}/Coverage/{coverage_id}"
+    url = f"/Coverage/{coverage_id}"
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            url,
-            headers={"Authorization": f"Bearer {medplum_token}"}
+    response = await request.app.state.http.get(
+        url,
+        headers={"Authorization": f"Bearer {medplum_token}"}
+    )
+    
+    if response.status_code == 404:
+        raise HTTPException(status_code=404, detail="Coverage not found")
+    elif response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Medplum API error: {response.text}"
         )
-        
-        if response.status_code == 404:
-            raise HTTPException(status_code=404, detail="Coverage not found")
-        elif response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Medplum API error: {response.text}"
-            )
-        
-        return response.json()
+    
+    return fhir_passthrough(response)
 
 
 # Reject all modification methods
@@ -1,13 +1,85 @@
-import hl7
-from typing import Dict, Optional, List
-from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Optional, List, Tuple
 
+# HL7 administrative sex (PID-8) -> FHIR gender
+_GENDER_MAP = {
+    "M": "male",
+    "F": "female",
+    "O": "other",
+    "U": "unknown"
+}
 
-def parse_hl7_message(hl7_message: str) -> hl7.Message:
-    """Parse HL7 message string into hl7.Message object"""
-    # Normalize line separators: CRLF or LF -> CR (HL7 standard)
-    hl7_message = hl7_message.replace('\r\n', '\r').replace('\n', '\r')
-    return hl7.parse(hl7_message)
+# Shared, read-only codings; resources are only serialized, never mutated
+_MRN_CODING = ({
+    "system": "http://terminology.hl7.org/CodeSystem/v2-0203",
+    "code": "MR",
+    "display": "Medical Record Number"
+},)
+
+_GROUP_CLASS_CODING = ({
+    "system": "http://terminology.hl7.org/CodeSystem/coverage-class",
+    "code": "group",
+    "display": "Group"
+},)
+
+_PLAN_CLASS_CODING = ({
+    "system": "http://terminology.hl7.org/CodeSystem/coverage-class",
+    "code": "plan",
+    "display": "Plan"
+},)
+
+
+def split_segments(hl7_message: str) -> List[str]:
+    """Split HL7 text into segment lines on CR, LF or CRLF, dropping MLLP framing"""
+    # Split on line breaks only: splitlines() would also break on \x1c-\x1e,
+    # \x85, U+2028 etc. and silently cut a segment at such a character
+    lines = hl7_message.replace('\r\n', '\r').replace('\n', '\r').split('\r')
+    
+    # MLLP wraps each message as \x0b<message>\x1c\r, so framing bytes only
+    # sit at the edges of a line; field data keeps any it contains
+    if '\x0b' in hl7_message or '\x1c' in hl7_message:
+        lines = [line.strip('\x0b\x1c') for line in lines]
+    
+    return lines
+
+
+def parse_minimal(hl7_message: str) -> List[List[str]]:
+    """
+    Extract PID and IN1 segments from HL7 message as plain field lists
+    
+    Only these two segments are mapped to FHIR, so other segments are
+    skipped without splitting their fields. Field n of a segment is at
+    index n (index 0 is the segment type).
+    """
+    lines = split_segments(hl7_message)
+    
+    segments = []
+    for line in lines:
+        if line.startswith('PID|') or line.startswith('IN1|'):
+            segments.append(line.split('|'))
+    
+    return segments
+
+
+def split_hl7_messages(hl7_payload: str) -> List[str]:
+    """Split a payload holding one or more HL7 messages at each MSH segment"""
+    # Common case: a single message, nothing to split
+    if hl7_payload.count('MSH|') <= 1:
+        return [hl7_payload]
+    
+    messages = []
+    current = []
+    for line in split_segments(hl7_payload):
+        if line.startswith('MSH|') and current:
+            messages.append('\r'.join(current))
+            current = []
+        if line:
+            current.append(line)
+    
+    if current:
+        messages.append('\r'.join(current))
+    
+    return messages
 
 
 def parse_hl7_date(date_str: str) -> Optional[str]:
@@ -25,27 +97,28 @@ def parse_hl7_date(date_str: str) -> Optional[str]:
         return None
 
 
-def parse_hl7_name(name_field) -> Dict:
+def parse_hl7_name(name_field: str) -> Dict:
     """Parse HL7 XPN (Extended Person Name) field into FHIR name structure"""
     # HL7 name format: LastName^FirstName^MiddleName^Suffix^Prefix
-    name_parts = str(name_field).split('^')
+    name_parts = name_field.split('^')
+    n = len(name_parts)
     
     fhir_name = {
         "use": "official",
-        "family": name_parts[0] if len(name_parts) > 0 else "",
+        "family": name_parts[0],  # split() always yields at least one part
         "given": []
     }
     
-    if len(name_parts) > 1 and name_parts[1]:
+    if n > 1 and name_parts[1]:
         fhir_name["given"].append(name_parts[1])
     
-    if len(name_parts) > 2 and name_parts[2]:
+    if n > 2 and name_parts[2]:
         fhir_name["given"].append(name_parts[2])
     
     return fhir_name
 
 
-def pid_to_fhir_patient(pid_segment) -> Dict:
+def pid_to_fhir_patient(pid_segment: List[str]) -> Dict:
     """Convert HL7 PID segment to FHIR Patient resource"""
     
     # Extract fields from PID segment
@@ -62,46 +135,42 @@ def pid_to_fhir_patient(pid_segment) -> Dict:
         "birthDate": None
     }
     
+    # Fields are plain strings; ones past the end of the segment are empty
+    n = len(pid_segment)
+    
     # PID-3: Patient Identifier (MRN)
-    if len(pid_segment) > 3 and pid_segment[3]:
-        mrn = str(pid_segment[3]).split('^')[0]  # Get ID from first component
+    mrn_field = pid_segment[3] if n > 3 else ""
+    if mrn_field:
+        mrn = mrn_field.split('^')[0]  # Get ID from first component
         patient["identifier"].append({
             "use": "usual",
             "type": {
-                "coding": [{
-                    "system": "http://terminology.hl7.org/CodeSystem/v2-0203",
-                    "code": "MR",
-                    "display": "Medical Record Number"
-                }]
+                "coding": _MRN_CODING
             },
             "value": mrn
         })
     
     # PID-5: Patient Name
-    if len(pid_segment) > 5 and pid_segment[5]:
-        patient["name"].append(parse_hl7_name(pid_segment[5]))
+    name_field = pid_segment[5] if n > 5 else ""
+    if name_field:
+        patient["name"].append(parse_hl7_name(name_field))
     
     # PID-7: Date of Birth
-    if len(pid_segment) > 7 and pid_segment[7]:
-        dob = parse_hl7_date(str(pid_segment[7]))
+    dob_field = pid_segment[7] if n > 7 else ""
+    if dob_field:
+        dob = parse_hl7_date(dob_field)
         if dob:
             patient["birthDate"] = dob
     
     # PID-8: Administrative Sex
-    if len(pid_segment) > 8 and pid_segment[8]:
-        gender_map = {
-            "M": "male",
-            "F": "female",
-            "O": "other",
-            "U": "unknown"
-        }
-        gender_code = str(pid_segment[8]).upper()
-        patient["gender"] = gender_map.get(gender_code, "unknown")
+    sex_field = pid_segment[8] if n > 8 else ""
+    if sex_field:
+        patient["gender"] = _GENDER_MAP.get(sex_field.upper(), "unknown")
     
     return patient
 
 
-def in1_to_fhir_coverage(in1_segment, patient_reference: str) -> Dict:
+def in1_to_fhir_coverage(in1_segment: List[str], patient_reference: str) -> Dict:
     """Convert HL7 IN1 segment to FHIR Coverage resource"""
     
     # Extract fields from IN1 segment
@@ -120,48 +189,43 @@ def in1_to_fhir_coverage(in1_segment, patient_reference: str) -> Dict:
         "payor": []
     }
     
+    # Fields are plain strings; ones past the end of the segment are empty
+    n = len(in1_segment)
+    
     # IN1-2: Member ID
-    if len(in1_segment) > 2 and in1_segment[2]:
-        member_id = str(in1_segment[2]).split('^')[0]
-        coverage["subscriberId"] = member_id
+    member_field = in1_segment[2] if n > 2 else ""
+    if member_field:
+        coverage["subscriberId"] = member_field.split('^')[0]
     
     # IN1-4: Insurance Company Name
-    if len(in1_segment) > 4 and in1_segment[4]:
-        insurance_name = str(in1_segment[4])
+    insurance_name = in1_segment[4] if n > 4 else ""
+    if insurance_name:
         coverage["payor"].append({
             "display": insurance_name
         })
     
     # IN1-8: Group Number
-    if len(in1_segment) > 8 and in1_segment[8]:
-        group_number = str(in1_segment[8]).strip()
+    if n > 8:
+        group_number = in1_segment[8].strip()
         if group_number:  # Only add if not empty
             if "class" not in coverage:
                 coverage["class"] = []
             coverage["class"].append({
                 "type": {
-                    "coding": [{
-                        "system": "http://terminology.hl7.org/CodeSystem/coverage-class",
-                        "code": "group",
-                        "display": "Group"
-                    }]
+                    "coding": _GROUP_CLASS_CODING
                 },
                 "value": group_number
             })
     
     # IN1-9: Group Name / Plan
-    if len(in1_segment) > 9 and in1_segment[9]:
-        plan_name = str(in1_segment[9]).strip()
+    if n > 9:
+        plan_name = in1_segment[9].strip()
         if plan_name:  # Only add if not empty
             if "class" not in coverage:
                 coverage["class"] = []
             coverage["class"].append({
                 "type": {
-                    "coding": [{
-                        "system": "http://terminology.hl7.org/CodeSystem/coverage-class",
-                        "code": "plan",
-                        "display": "Plan"
-                    }]
+                    "coding": _PLAN_CLASS_CODING
                 },
                 "value": plan_name,
                 "name": plan_name
@@ -170,26 +234,20 @@ def in1_to_fhir_coverage(in1_segment, patient_reference: str) -> Dict:
     return coverage
 
 
-def convert_hl7_to_fhir(hl7_message: str) -> Dict[str, any]:
-    """
-    Convert HL7 ADT message to FHIR resources
-    
-    Returns:
-        Dictionary with 'patient' and optionally 'coverage' FHIR resources
-    """
-    message = parse_hl7_message(hl7_message)
+@lru_cache(maxsize=1024)
+def _convert_hl7_to_fhir_cached(hl7_message: str) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """Map PID/IN1 to (patient, coverage); cached since senders retransmit on ACK timeout"""
+    segments = parse_minimal(hl7_message)
     
-    result = {
-        "patient": None,
-        "coverage": None
-    }
+    patient = None
+    coverage = None
     
     # Find PID segment
     pid_segment = None
     in1_segment = None
     
-    for segment in message:
-        segment_type = str(segment[0])
+    for segment in segments:
+        segment_type = segment[0]
         
         if segment_type == "PID":
             pid_segment = segment
@@ -198,12 +256,29 @@ def convert_hl7_to_fhir(hl7_message: str) -> Dict[str, any]:
     
     # Convert PID to Patient
     if pid_segment:
-        result["patient"] = pid_to_fhir_patient(pid_segment)
+        patient = pid_to_fhir_patient(pid_segment)
         
         # Convert IN1 to Coverage if present
         if in1_segment:
             # We need a patient reference - use temporary ID
-            patient_id = result["patient"]["identifier"][0]["value"] if result["patient"]["identifier"] else "temp"
-            result["coverage"] = in1_to_fhir_coverage(in1_segment, f"Patient/{patient_id}")
+            patient_id = patient["identifier"][0]["value"] if patient["identifier"] else "temp"
+            coverage = in1_to_fhir_coverage(in1_segment, f"Patient/{patient_id}")
     
-    return result
\ No newline at end of file
+    return patient, coverage
+
+
+def convert_hl7_to_fhir(hl7_message: str) -> Dict[str, any]:
+    """
+    Convert HL7 ADT message to FHIR resources
+    
+    Conversions are cached per message text, so the returned resources are
+    shared between calls and must not be mutated; copy them first.
+    
+    Returns:
+        Dictionary with 'patient' and optionally 'coverage' FHIR resources
+    """
+    patient, coverage = _convert_hl7_to_fhir_cached(hl7_message)
+    return {
+        "patient": patient,
+        "coverage": coverage
+    }
\ No newline at end of file
@@ -1,89 +1,111 @@
-import httpx
+import asyncio
+import orjson
 from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.responses import JSONResponse
 from .auth import verify_token, get_medplum_token
-from .hl7_converter import convert_hl7_to_fhir
-import os
+from .hl7_converter import convert_hl7_to_fhir, split_hl7_messages
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import nullcontext
+from typing import List, Optional
+from urllib.parse import quote
 
-MEDPLUM_BASE_URL = os.getenv("MEDPLUM_BASE_URL", "https://api.medplum.com/fhir/R4")
+# Short-lived MRN -> Patient ID cache so resent ADT messages skip the search
+MRN_CACHE_TTL = 60  # seconds
+MRN_CACHE_MAX_SIZE = 10_000
+mrn_cache = OrderedDict()  # mrn -> (patient_id, expires_at)
+
+# Max messages from one batch talking to Medplum at the same time
+HL7_BATCH_CONCURRENCY = 20
 
 router = APIRouter(prefix="/hl7", tags=["HL7"])
 
 
-async def search_patient_by_mrn(mrn: str, medplum_token: str) -> dict:
-    """Search for existing patient by MRN identifier"""
-    url = f"{MEDPLUM_BASE_URL}/Patient"
+def get_cached_patient_id(mrn: str) -> Optional[str]:
+    """Return cached Patient ID for MRN, or None if missing or expired"""
+    entry = mrn_cache.get(mrn)
+    if entry is None:
+        return None
     
-    async with httpx.AsyncClient() as client:
-        # Get ALL patients and search through them
-        response = await client.get(
-            url,
-            headers={"Authorization": f"Bearer {medplum_token}"}
-        )
-        
-        if response.status_code == 200:
-            bundle = response.json()
-            if bundle.get("entry"):
-                # Check every patient for matching MRN
-                for entry in bundle.get("entry", []):
-                    patient = entry.get("resource", {})
-                    identifiers = patient.get("identifier", [])
-                    for identifier in identifiers:
-                        # Match on value only
-                        if identifier.get("value") == mrn:
-                            print(f"Found existing patient with MRN {mrn}: {patient.get('id')}")
-                            return patient
-        
-        print(f"No existing patient found with MRN {mrn}")
+    patient_id, expires_at = entry
+    if time.monotonic() > expires_at:
+        del mrn_cache[mrn]
         return None
+    
+    return patient_id
 
 
-async def create_fhir_resource(resource: dict, medplum_token: str) -> dict:
-    """Create a FHIR resource in Medplum"""
-    resource_type = resource["resourceType"]
-    url = f"{MEDPLUM_BASE_URL}/{resource_type}"
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            url,
-            json=resource,
-            headers={
-                "Authorization": f"Bearer {medplum_token}",
-                "Content-Type": "application/fhir+json"
-            }
-        )
-        
-        if response.status_code not in [200, 201]:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Failed to create {resource_type}: {response.text}"
-            )
-        
-        return response.json()
+def cache_patient_id(mrn: str, patient_id: str):
+    """Cache Patient ID for MRN, evicting expired then oldest entries when full"""
+    mrn_cache.pop(mrn, None)
+    
+    if len(mrn_cache) >= MRN_CACHE_MAX_SIZE:
+        # Every entry gets the same TTL and re-inserts were popped above, so
+        # insertion order is expiry order: expired entries are at the front.
+        # OrderedDict pops from the front in O(1), unlike a plain dict.
+        now = time.monotonic()
+        while mrn_cache and next(iter(mrn_cache.values()))[1] < now:
+            mrn_cache.popitem(last=False)
+        if len(mrn_cache) >= MRN_CACHE_MAX_SIZE:
+            mrn_cache.popitem(last=False)  # oldest entry
+    
+    mrn_cache[mrn] = (patient_id, time.monotonic() + MRN_CACHE_TTL)
 
 
-@router.post("/inbound")
-async def receive_hl7_message(
-    request: Request,
-    token: str = Depends(verify_token),
-    medplum_token: str = Depends(get_medplum_token)
-):
-    """
-    Receive HL7 v2 ADT messages and convert them to FHIR resources
+async def search_patient_by_mrn(request: Request, mrn: str, medplum_token: str) -> Optional[str]:
+    """Search for existing patient by MRN identifier, returning the Patient ID"""
+    patient_id = get_cached_patient_id(mrn)
+    if patient_id:
+        print(f"Found cached patient with MRN {mrn}: {patient_id}")
+        return patient_id
     
-    Expects plain text HL7 message in request body
-    """
-    # Get raw HL7 message from request body
-    hl7_message = await request.body()
-    hl7_message = hl7_message.decode('utf-8')
+    # Let Medplum filter on its identifier index; a token search without a
+    # system matches on value only, same as before
+    url = f"/Patient?identifier={quote(mrn, safe='')}&_count=1"
     
-    if not hl7_message:
+    response = await request.app.state.http.get(
+        url,
+        headers={"Authorization": f"Bearer {medplum_token}"}
+    )
+    
+    if response.status_code == 200:
+        bundle = orjson.loads(response.content)
+        # Medplum omits "total" unless _total is requested, so check entries
+        if bundle.get("entry"):
+            patient_id = bundle["entry"][0]["resource"]["id"]
+            print(f"Found existing patient with MRN {mrn}: {patient_id}")
+            cache_patient_id(mrn, patient_id)
+            return patient_id
+    
+    print(f"No existing patient found with MRN {mrn}")
+    return None
+
+
+async def create_fhir_resource(request: Request, resource: dict, medplum_token: str) -> dict:
+    """Create a FHIR resource in Medplum"""
+    resource_type = resource["resourceType"]
+    url = f"/{resource_type}"
+    
+    response = await request.app.state.http.post(
+        url,
+        content=orjson.dumps(resource),
+        headers={
+            "Authorization": f"Bearer {medplum_token}",
+            "Content-Type": "application/fhir+json"
+        }
+    )
+    
+    if response.status_code not in [200, 201]:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Empty HL7 message"
+            status_code=response.status_code,
+            detail=f"Failed to create {resource_type}: {response.text}"
         )
     
-    # Convert HL7 to FHIR
+    return orjson.loads(response.content)
+
+
+def convert_hl7_message(hl7_message: str) -> dict:
+    """Convert a single HL7 message to FHIR resources, raising 400 on bad input"""
     try:
         fhir_resources = convert_hl7_to_fhir(hl7_message)
     except Exception as e:
@@ -98,6 +120,18 @@ async def receive_hl7_message(
             detail="No patient information found in HL7 message"
         )
     
+    return fhir_resources
+
+
+def get_patient_mrn(patient_resource: dict) -> Optional[str]:
+    """Get MRN from the first identifier of a converted Patient resource"""
+    if patient_resource.get("identifier"):
+        return patient_resource["identifier"][0]["value"]
+    return None
+
+
+async def store_fhir_resources(request: Request, fhir_resources: dict, medplum_token: str) -> dict:
+    """Find or create the Patient, then create its Coverage, in Medplum"""
     summary = {
         "patient": {"action": None, "id": None},
         "coverage": {"action": None, "id": None}
@@ -105,34 +139,43 @@ async def receive_hl7_message(
     
     # Check if patient exists by MRN
     patient_resource = fhir_resources["patient"]
-    mrn = None
-    if patient_resource.get("identifier"):
-        mrn = patient_resource["identifier"][0]["value"]
+    mrn = get_patient_mrn(patient_resource)
     
-    existing_patient = None
+    existing_patient_id = None
     if mrn:
-        existing_patient = await search_patient_by_mrn(mrn, medplum_token)
+        existing_patient_id = await search_patient_by_mrn(request, mrn, medplum_token)
     
     # Create or use existing patient
-    if existing_patient:
+    if existing_patient_id:
         summary["patient"]["action"] = "found"
-        summary["patient"]["id"] = existing_patient["id"]
-        patient_id = existing_patient["id"]
+        summary["patient"]["id"] = existing_patient_id
+        patient_id = existing_patient_id
     else:
         # Create new patient
-        created_patient = await create_fhir_resource(patient_resource, medplum_token)
+        created_patient = await create_fhir_resource(request, patient_resource, medplum_token)
         summary["patient"]["action"] = "created"
         summary["patient"]["id"] = created_patient["id"]
         patient_id = created_patient["id"]
+        if mrn:
+            cache_patient_id(mrn, patient_id)
     
     # Handle coverage if present
     if fhir_resources.get("coverage"):
-        coverage_resource = fhir_resources["coverage"]
-        # Update beneficiary reference with actual patient ID
-        coverage_resource["beneficiary"]["reference"] = f"Patient/{patient_id}"
+        # Point beneficiary at the actual patient ID; copy rather than mutate,
+        # since converted resources are cached and shared
+        coverage_resource = {
+            **fhir_resources["coverage"],
+            "beneficiary": {"reference": f"Patient/{patient_id}"}
+        }
         
         # Create coverage
-        created_coverage = await create_fhir_resource(coverage_resource, medplum_token)
+        try:
+            created_coverage = await create_fhir_resource(request, coverage_resource, medplum_token)
+        except HTTPException as e:
+            # Cached patient may have been deleted or merged in Medplum
+            if mrn and e.status_code in (404, 409):
+                mrn_cache.pop(mrn, None)
+            raise
         summary["coverage"]["action"] = "created"
         summary["coverage"]["id"] = created_coverage["id"]
     
@@ -142,6 +185,70 @@ async def receive_hl7_message(
     }
 
 
+async def process_hl7_batch(request: Request, hl7_messages: List[str], medplum_token: str) -> List[dict]:
+    """
+    Process several HL7 messages concurrently
+    
+    At most HL7_BATCH_CONCURRENCY messages talk to Medplum at once. Messages
+    for the same MRN run one after another so the patient is created once.
+    A failed message yields {"error": {"status_code", "detail"}} in its slot
+    instead of failing the whole batch.
+    """
+    semaphore = asyncio.Semaphore(HL7_BATCH_CONCURRENCY)
+    mrn_locks = defaultdict(asyncio.Lock)
+    
+    async def process_one(hl7_message: str) -> dict:
+        try:
+            fhir_resources = convert_hl7_message(hl7_message)
+            mrn = get_patient_mrn(fhir_resources["patient"])
+            async with mrn_locks[mrn] if mrn else nullcontext():
+                async with semaphore:
+                    return await store_fhir_resources(request, fhir_resources, medplum_token)
+        except HTTPException as e:
+            return {"error": {"status_code": e.status_code, "detail": e.detail}}
+        except Exception as e:
+            return {"error": {"status_code": status.HTTP_500_INTERNAL_SERVER_ERROR, "detail": str(e)}}
+    
+    return await asyncio.gather(*(process_one(hl7_message) for hl7_message in hl7_messages))
+
+
+@router.post("/inbound")
+async def receive_hl7_message(
+    request: Request,
+    token: str = Depends(verify_token),
+    medplum_token: str = Depends(get_medplum_token)
+):
+    """
+    Receive HL7 v2 ADT messages and convert them to FHIR resources
+    
+    Expects plain text HL7 message in request body. A body holding several
+    messages (each starting with MSH) is processed as a batch and returns
+    one entry per message under "results".
+    """
+    # Get raw HL7 message from request body
+    hl7_message = await request.body()
+    hl7_message = hl7_message.decode('utf-8')
+    
+    if not hl7_message:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Empty HL7 message"
+        )
+    
+    hl7_messages = split_hl7_messages(hl7_message)
+    
+    if len(hl7_messages) == 1:
+        # Convert HL7 to FHIR
+        fhir_resources = convert_hl7_message(hl7_message)
+        return await store_fhir_resources(request, fhir_resources, medplum_token)
+    
+    results = await process_hl7_batch(request, hl7_messages, medplum_token)
+    return {
+        "message": f"Processed {len(results)} HL7 messages",
+        "results": results
+    }
+
+
 @router.get("/health")
 async def hl7_health():
     """Health check endpoint for HL7 service"""
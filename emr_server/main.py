@@ -1,16 +1,63 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+import httpx
 from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.exceptions import RequestValidationError
-from emr_server.fhir_proxy import router as fhir_router
+from emr_server.fhir_proxy import router as fhir_router, MEDPLUM_BASE_URL
 from emr_server.hl7_endpoint import router as hl7_router
-from emr_server.auth import create_access_token
+from emr_server.auth import (
+    close_redis, create_access_token, init_redis, run_token_sweeper, TOKEN_LIFETIME
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared resources on startup and release them on shutdown"""
+    print("EMR Server starting up...")
+    # Single pooled client for all outbound Medplum calls.
+    # Keep idle connections for 30s (httpx default is 5s) so the TLS session
+    # survives gaps between sporadic FHIR calls; HTTP/2 multiplexes
+    # concurrent requests over one connection.
+    app.state.http = httpx.AsyncClient(
+        base_url=MEDPLUM_BASE_URL,
+        limits=httpx.Limits(
+            max_keepalive_connections=50,
+            max_connections=100,
+            keepalive_expiry=30.0
+        ),
+        timeout=httpx.Timeout(10.0),
+        http2=True
+    )
+    # Share client tokens and the Medplum token across workers when Redis
+    # is configured; Redis expires client tokens itself
+    token_sweeper = None
+    if not init_redis():
+        # Evict issued-but-unused client tokens so token_store stays bounded
+        token_sweeper = asyncio.create_task(run_token_sweeper())
+    print("FHIR Proxy endpoints available at /fhir/*")
+    print("HL7 Inbound endpoint available at /hl7/inbound")
+    print("Authentication endpoint at /auth/token")
+    
+    yield
+    
+    print("EMR Server shutting down...")
+    if token_sweeper is not None:
+        token_sweeper.cancel()
+        with suppress(asyncio.CancelledError):
+            await token_sweeper
+    await app.state.http.aclose()
+    await close_redis()
+
 
 # Create FastAPI application
 app = FastAPI(
     title="EMR Server",
     description="EMR Server that wraps Medplum FHIR API and provides HL7 integration",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS
@@ -79,11 +126,11 @@ async def get_token():
         token_type: "bearer"
         expires_in: Token validity in seconds (86400 = 24 hours)
     """
-    token = create_access_token()
+    token = await create_access_token()
     return {
         "access_token": token,
         "token_type": "bearer",
-        "expires_in": 86400
+        "expires_in": TOKEN_LIFETIME
     }
 
 
@@ -94,20 +141,3 @@ async def health_check():
         "status": "healthy",
         "service": "EMR Server"
     }
-
-
-# Startup event
-@app.on_event("startup")
-async def startup_event():
-    """Run on application startup"""
-    print("EMR Server starting up...")
-    print("FHIR Proxy endpoints available at /fhir/*")
-    print("HL7 Inbound endpoint available at /hl7/inbound")
-    print("Authentication endpoint at /auth/token")
-
-
-# Shutdown event
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Run on application shutdown"""
-    print("EMR Server shutting down...")
\ No newline at end of file
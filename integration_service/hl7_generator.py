@@ -1,6 +1,9 @@
 from datetime import datetime
 from typing import Optional
 
+# Gender inputs mapped to HL7 "M"; anything else is sent as "F"
+_MALE_VALUES = frozenset({"MALE", "M"})
+
 
 def format_date_for_hl7(date_str: str) -> str:
     """
@@ -17,7 +20,13 @@ def format_date_for_hl7(date_str: str) -> str:
         raise ValueError(f"Invalid date format. Expected MM/DD/YYYY, got {date_str}")
     
     month, day, year = parts
-    return f"{year}{month.zfill(2)}{day.zfill(2)}"
+    # Same check as ^\d{1,2}/\d{1,2}/\d{4}$, but without the regex engine
+    digits = month + day + year
+    if not (0 < len(month) < 3 and 0 < len(day) < 3 and len(year) == 4
+            and digits.isascii() and digits.isdigit()):
+        raise ValueError(f"Invalid date format. Expected MM/DD/YYYY, got {date_str}")
+    
+    return year + month.zfill(2) + day.zfill(2)
 
 
 def generate_hl7_adt_message(
@@ -29,7 +38,9 @@ def generate_hl7_adt_message(
     insurance_name: Optional[str] = None,
     member_id: Optional[str] = None,
     plan: Optional[str] = None,
-    group_number: Optional[str] = None
+    group_number: Optional[str] = None,
+    now: Optional[datetime] = None,
+    sequence: Optional[int] = None
 ) -> str:
     """
     Generate HL7 ADT^A04 message from patient data
@@ -51,19 +62,32 @@ def generate_hl7_adt_message(
         member_id: Insurance member ID (optional)
         plan: Insurance plan name (optional)
         group_number: Insurance group number (optional)
+        now: Message timestamp (optional, defaults to datetime.now()); batch
+            callers can compute it once outside their loop
+        sequence: Per-message counter appended to generated IDs (optional),
+            keeps message IDs and MRNs unique when now is shared; must be
+            0-999 so MSH-10 stays within its 20-character limit
         
     Returns:
         HL7 message string with segments separated by CR (\\r)
     """
+    if sequence is not None and not 0 <= sequence < 1000:
+        raise ValueError(f"sequence must be between 0 and 999, got {sequence}")
+    
     # Generate message timestamp
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    if now is None:
+        now = datetime.now()
+    timestamp = now.strftime("%Y%m%d%H%M%S")
+    
+    # Suffix for generated IDs; a shared timestamp alone would collide
+    unique_id = timestamp if sequence is None else f"{timestamp}{sequence:03d}"
     
     # Generate MRN if not provided
     if not mrn:
-        mrn = f"MRN{timestamp}"
+        mrn = f"MRN{unique_id}"
     
     # Generate unique message ID
-    msg_id = f"MSG{timestamp}"
+    msg_id = f"MSG{unique_id}"
     
     # MSH - Message Header segment
     msh = f"MSH|^~\\&|INTEGRATION|CLINIC|EMR|HOSPITAL|{timestamp}||ADT^A04|{msg_id}|P|2.5"
@@ -73,7 +97,7 @@ def generate_hl7_adt_message(
     hl7_dob = format_date_for_hl7(dob)
     
     # Convert gender
-    hl7_gender = "M" if gender.upper() in ["MALE", "M"] else "F"
+    hl7_gender = "M" if gender.upper() in _MALE_VALUES else "F"
     
     # PID format: PID|SetID|PatientID|PatientIdentifierList|AlternatePatientID|PatientName|...
     pid = f"PID|1||{mrn}^^^MRN||{last_name}^{first_name}||{hl7_dob}|{hl7_gender}"
@@ -84,29 +108,10 @@ def generate_hl7_adt_message(
     # IN1 - Insurance segment (optional)
     if insurance_name and member_id:
         # IN1 format: IN1|SetID|InsurancePlanID|InsuranceCompanyID|InsuranceCompanyName|...
-        in1_parts = [
-            "IN1",
-            "1",  # Set ID
-            member_id or "",  # Insurance Plan ID
-            "",  # Insurance Company ID (empty)
-            insurance_name or "",  # Insurance Company Name
-            "",  # Insurance Company Address
-            "",  # Insurance Company Contact Person
-            "",  # Insurance Company Phone Number
-            "",  # Group Number field (IN1-8)
-        ]
-        
-        # Add group number at position 8 if provided
-        if group_number:
-            in1_parts.append(group_number)
-        else:
-            in1_parts.append("")
-        
-        # Add plan at position 9 if provided
+        # then four empty company address/contact fields, group number and plan
+        in1 = f"IN1|1|{member_id}||{insurance_name}|||||{group_number or ''}"
         if plan:
-            in1_parts.append(plan)
-        
-        in1 = "|".join(in1_parts)
+            in1 += f"|{plan}"
         segments.append(in1)
     
     # Join segments with CR (carriage return) - HL7 standard
@@ -1,14 +1,62 @@
+from contextlib import asynccontextmanager
+import httpx
 from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
-from integration_service.patient_service import router as patient_router
+import os
+from integration_service.patient_service import router as patient_router, BatchSender
+
+DEFAULT_EMR_SERVER_URL = "http://localhost:8000"
+
+
+def resolve_emr_server_url() -> str:
+    """Read EMR_SERVER_URL, parsing .env only when it is not already set"""
+    if not os.getenv("EMR_SERVER_URL"):
+        from dotenv import load_dotenv
+        load_dotenv()
+    return os.getenv("EMR_SERVER_URL", DEFAULT_EMR_SERVER_URL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared resources on startup and release them on shutdown"""
+    print("Integration Service starting up...")
+    app.state.emr_server_url = resolve_emr_server_url()
+    # Single pooled client for all outbound EMR Server calls.
+    # HTTP/2 multiplexes concurrent requests over one connection (negotiated
+    # via TLS ALPN, so plain http:// URLs stay on HTTP/1.1); with fewer
+    # sockets needed, keep a smaller idle pool alive for 30s.
+    # Fail fast when the EMR is unreachable or the pool is exhausted, so a
+    # hung backend does not tie up request coroutines.
+    app.state.http = httpx.AsyncClient(
+        base_url=app.state.emr_server_url,
+        limits=httpx.Limits(
+            max_keepalive_connections=50,
+            max_connections=200,
+            keepalive_expiry=30.0
+        ),
+        timeout=httpx.Timeout(connect=2.0, read=10.0, write=5.0, pool=5.0),
+        http2=True
+    )
+    # Coalesces concurrent HL7 sends into EMR batch requests
+    app.state.hl7_sender = BatchSender(app.state.http)
+    app.state.hl7_sender.start()
+    print("Patient service available at /patient/")
+    
+    yield
+    
+    print("Integration Service shutting down...")
+    await app.state.hl7_sender.stop()
+    await app.state.http.aclose()
+
 
 # Create FastAPI application
 app = FastAPI(
     title="Integration Service",
     description="Integration service that syncs patient data with EMR Server",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -71,18 +119,3 @@ async def health_check():
         "status": "healthy",
         "service": "Integration Service"
     }
-
-
-# Startup event
-@app.on_event("startup")
-async def startup_event():
-    """Run on application startup"""
-    print("Integration Service starting up...")
-    print("Patient service available at /patient/")
-
-
-# Shutdown event
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Run on application shutdown"""
-    print("Integration Service shutting down...")
\ No newline at end of file
@@ -1,14 +1,48 @@
+import asyncio
+import time
 import httpx
-from fastapi import APIRouter, HTTPException, status
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Optional, Tuple
+from urllib.parse import quote
 from datetime import datetime, timedelta
-import os
-from dotenv import load_dotenv
+from collections import OrderedDict
+from contextlib import suppress
+from functools import lru_cache
 
-load_dotenv()
+# Longest slice of an EMR error body copied into our error detail
+ERROR_BODY_LIMIT = 1024
 
-EMR_SERVER_URL = os.getenv("EMR_SERVER_URL", "http://localhost:8000")
+# The EMR processes this many messages of a batch at once (its
+# HL7_BATCH_CONCURRENCY); each makes up to three sequential Medplum calls
+# (search, Patient, Coverage) of up to 10s, so allow that per round
+EMR_HL7_BATCH_CONCURRENCY = 20
+HL7_MESSAGE_TIMEOUT = 30.0  # seconds
+
+# Outgoing HL7 messages are coalesced into batches of at most this many,
+# collected over at most this many seconds (see BatchSender). One batch
+# is one EMR round, so it takes about as long as a single message.
+HL7_BATCH_MAX_SIZE = EMR_HL7_BATCH_CONCURRENCY
+HL7_BATCH_MAX_WAIT = 0.005
+
+# Patient search by MRN, relative to the shared client's base_url
+PATIENT_SEARCH_URL = "/fhir/Patient?identifier="
+
+# Short-lived cache of MRN lookups: mrn -> (patient or None, expires_at)
+PATIENT_CACHE_TTL = 30  # seconds
+PATIENT_CACHE_NEGATIVE_TTL = 5  # seconds; "not found" goes stale on create
+PATIENT_CACHE_MAX_SIZE = 10_000
+patient_cache = OrderedDict()
+# One lock per MRN being looked up, so concurrent misses share one search
+patient_cache_locks = {}
+_MISSING = object()
+
+# Gender inputs mapped to HL7 "M"; anything else is sent as "F"
+_MALE_VALUES = frozenset({"MALE", "M"})
+
+# (epoch second, HL7 timestamp, MSH segment) last built by get_hl7_header
+_hl7_header = (None, "", "")
 
 router = APIRouter(prefix="/patient", tags=["Patient Service"])
 
@@ -25,7 +59,8 @@ class PatientData(BaseModel):
     mrn: Optional[str] = None
     lastName: str
     firstName: str
-    dob: str  # Format: MM/DD/YYYY
+    # Format: MM/DD/YYYY, checked by pydantic-core at parse time
+    dob: str = Field(..., pattern=r"^[0-9]{1,2}/[0-9]{1,2}/[0-9]{4}$")
     gender: str  # "Male" or "Female"
     insurance: Optional[InsuranceInfo] = None
 
@@ -36,15 +71,28 @@ class IntegrationServiceAuth:
     def __init__(self):
         self.access_token: Optional[str] = None
         self.token_expiry: Optional[datetime] = None
+        # Request headers for the current token, rebuilt on each refresh
+        self.auth_headers: Optional[dict] = None
+        self.hl7_headers: Optional[dict] = None
+        # Serializes refreshes so concurrent requests share one token fetch
+        self._lock = asyncio.Lock()
+    
+    def _has_valid_token(self) -> bool:
+        """Check if the cached token can still be used"""
+        return bool(self.access_token and self.token_expiry and datetime.now() < self.token_expiry)
     
-    async def get_access_token(self) -> str:
+    async def get_access_token(self, client: httpx.AsyncClient) -> str:
         """Get valid access token from EMR Server"""
-        if self.access_token and self.token_expiry and datetime.now() < self.token_expiry:
+        if self._has_valid_token():
             return self.access_token
         
-        # Request new token from EMR Server
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{EMR_SERVER_URL}/auth/token")
+        async with self._lock:
+            # Another coroutine may have refreshed while we waited for the lock
+            if self._has_valid_token():
+                return self.access_token
+            
+            # Request new token from EMR Server
+            response = await client.post("/auth/token")
             
             if response.status_code != 200:
                 raise HTTPException(
@@ -52,143 +100,367 @@ class IntegrationServiceAuth:
                     detail="Failed to authenticate with EMR Server"
                 )
             
-            token_data = response.json()
+            token_data = orjson.loads(response.content)
             self.access_token = token_data["access_token"]
+            self.auth_headers = {"Authorization": f"Bearer {self.access_token}"}
+            self.hl7_headers = {**self.auth_headers, "Content-Type": "text/plain"}
             # Token expires in 24 hours, refresh 1 hour before
             self.token_expiry = datetime.now() + timedelta(seconds=82800)
             
             return self.access_token
 
 
-# Global auth instance
-emr_auth = IntegrationServiceAuth()
+@lru_cache(maxsize=None)
+def get_auth() -> IntegrationServiceAuth:
+    """Dependency returning the process-wide EMR Server auth (one token cache)"""
+    return IntegrationServiceAuth()
+
+
+def get_http(request: Request) -> httpx.AsyncClient:
+    """Dependency returning the pooled EMR client created in the lifespan"""
+    return request.app.state.http
+
+
+def get_hl7_sender(request: Request) -> "BatchSender":
+    """Dependency returning the HL7 batch sender created in the lifespan"""
+    return request.app.state.hl7_sender
 
 
-async def check_patient_exists(mrn: str, token: str) -> Optional[dict]:
+def error_body(response: httpx.Response) -> str:
+    """Decode at most ERROR_BODY_LIMIT bytes of an error response body"""
+    return response.content[:ERROR_BODY_LIMIT].decode("utf-8", errors="replace")
+
+
+async def check_patient_exists(
+    client: httpx.AsyncClient,
+    mrn: str,
+    headers: dict
+) -> Optional[dict]:
     """Check if patient exists in EMR by MRN"""
     if not mrn:
         return None
     
-    url = f"{EMR_SERVER_URL}/fhir/Patient"
-    params = {"identifier": mrn}
-    headers = {"Authorization": f"Bearer {token}"}
+    url = PATIENT_SEARCH_URL + quote(mrn, safe='')
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, params=params, headers=headers)
-        
-        if response.status_code != 200:
-            return None
-        
-        bundle = response.json()
-        
-        # Check if we found any patients and verify MRN matches
-        if bundle.get("total", 0) > 0 and bundle.get("entry"):
-            for entry in bundle.get("entry", []):
-                patient = entry.get("resource", {})
-                identifiers = patient.get("identifier", [])
-                for identifier in identifiers:
-                    if identifier.get("value") == mrn:
-                        return patient
-        
+    response = await client.get(url, headers=headers)
+    
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Failed to search EMR patients: {error_body(response)}"
+        )
+    
+    bundle = orjson.loads(response.content)
+    
+    # No match is the common case on create; bail out before any scanning.
+    # Medplum omits "total" unless _total is requested, so go by entries.
+    entries = bundle.get("entry")
+    if not entries:
         return None
+    
+    # First patient carrying the MRN; next() stops at the first match
+    return next(
+        (
+            patient
+            for patient in (entry.get("resource", {}) for entry in entries)
+            if any(identifier.get("value") == mrn for identifier in patient.get("identifier", []))
+        ),
+        None
+    )
 
 
-async def send_hl7_to_emr(hl7_message: str, token: str) -> dict:
-    """Send HL7 message to EMR Server"""
-    url = f"{EMR_SERVER_URL}/hl7/inbound"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "text/plain"
-    }
+def get_cached_patient(mrn: str):
+    """Return cached lookup result for MRN (may be None), or _MISSING"""
+    entry = patient_cache.get(mrn)
+    if entry is None:
+        return _MISSING
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, content=hl7_message, headers=headers)
-        
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Failed to send HL7 to EMR: {response.text}"
-            )
-        
-        return response.json()
+    patient, expires_at = entry
+    if time.monotonic() > expires_at:
+        del patient_cache[mrn]
+        return _MISSING
+    
+    return patient
 
 
-def format_date_for_hl7(date_str: str) -> str:
-    """Convert MM/DD/YYYY to YYYYMMDD for HL7"""
+def cache_patient(mrn: str, patient: Optional[dict]):
+    """Cache lookup result for MRN, evicting expired then oldest entries when full"""
+    patient_cache.pop(mrn, None)
+    
+    if len(patient_cache) >= PATIENT_CACHE_MAX_SIZE:
+        # Drop the expired prefix, then the oldest entry if still full; never
+        # rescan the whole cache. With two TTLs an expired "not found" entry
+        # can sit behind a live one, but only until it reaches the front or
+        # is looked up. OrderedDict pops from the front in O(1).
+        now = time.monotonic()
+        while patient_cache and next(iter(patient_cache.values()))[1] < now:
+            patient_cache.popitem(last=False)
+        if len(patient_cache) >= PATIENT_CACHE_MAX_SIZE:
+            patient_cache.popitem(last=False)  # oldest entry
+    
+    ttl = PATIENT_CACHE_TTL if patient is not None else PATIENT_CACHE_NEGATIVE_TTL
+    patient_cache[mrn] = (patient, time.monotonic() + ttl)
+
+
+async def find_patient_by_mrn(
+    client: httpx.AsyncClient,
+    mrn: str,
+    headers: dict
+) -> Optional[dict]:
+    """check_patient_exists with a short-lived cache in front of it"""
+    if not mrn:
+        return None
+    
+    patient = get_cached_patient(mrn)
+    if patient is not _MISSING:
+        return patient
+    
+    lock = patient_cache_locks.setdefault(mrn, asyncio.Lock())
     try:
-        # Parse MM/DD/YYYY
-        parts = date_str.split('/')
-        if len(parts) != 3:
-            raise ValueError("Invalid date format")
-        
-        month, day, year = parts
-        # Return YYYYMMDD
-        return f"{year}{month.zfill(2)}{day.zfill(2)}"
-    except:
+        async with lock:
+            # A concurrent lookup may have filled the cache while we waited
+            patient = get_cached_patient(mrn)
+            if patient is not _MISSING:
+                return patient
+            
+            try:
+                patient = await check_patient_exists(client, mrn, headers)
+            except HTTPException:
+                # Failed searches count as "not found", but are not cached
+                return None
+            
+            cache_patient(mrn, patient)
+            return patient
+    finally:
+        if patient_cache_locks.get(mrn) is lock and not lock.locked():
+            del patient_cache_locks[mrn]
+
+
+async def send_hl7_to_emr(
+    client: httpx.AsyncClient,
+    hl7_message: str,
+    headers: dict,
+    timeout: Optional[httpx.Timeout] = None
+) -> dict:
+    """Send HL7 message to EMR Server, optionally overriding the client timeout"""
+    url = "/hl7/inbound"
+    
+    response = await client.post(
+        url,
+        content=hl7_message,
+        headers=headers,
+        timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+    )
+    
+    if response.status_code != 200:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Invalid date format. Expected MM/DD/YYYY, got {date_str}"
+            status_code=response.status_code,
+            detail=f"Failed to send HL7 to EMR: {error_body(response)}"
         )
+    
+    return orjson.loads(response.content)
 
 
-def generate_hl7_message(patient_data: PatientData) -> str:
-    """Generate HL7 ADT^A04 message from patient data"""
-    from datetime import datetime
+class BatchSender:
+    """
+    Coalesce HL7 messages sent close together into one EMR request
+    
+    The first queued message opens a window of max_wait seconds; everything
+    queued by then (up to max_batch_size) goes upstream as one multi-message
+    body, which the EMR processes as a batch. Each caller gets back its own
+    entry from the batch results, or an HTTPException for a failed message.
+    
+    The EMR answers only once every message in the batch is done, so the
+    batch request's read timeout grows with the number of EMR rounds the
+    batch needs (message_timeout per EMR_HL7_BATCH_CONCURRENCY messages).
+    """
+    
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        max_batch_size: int = HL7_BATCH_MAX_SIZE,
+        max_wait: float = HL7_BATCH_MAX_WAIT,
+        message_timeout: float = HL7_MESSAGE_TIMEOUT
+    ):
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.message_timeout = message_timeout
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        # Batches still waiting on the EMR; referenced so they are not GC'd
+        self._in_flight = set()
+    
+    def start(self):
+        """Start the background task that drains the queue"""
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop draining the queue and wait for batches already sent"""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
+    
+    async def send(self, hl7_message: str, headers: dict) -> dict:
+        """Queue one HL7 message and wait for its EMR response"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((hl7_message, headers, future))
+        return await future
+    
+    def batch_timeout(self, batch_size: int) -> httpx.Timeout:
+        """Client timeout with the read budget scaled to the batch size"""
+        rounds = -(-batch_size // EMR_HL7_BATCH_CONCURRENCY)  # ceil division
+        timeout = self.client.timeout
+        return httpx.Timeout(
+            connect=timeout.connect,
+            read=self.message_timeout * rounds,
+            write=timeout.write,
+            pool=timeout.pool
+        )
+    
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            
+            # Send without blocking the next window on this batch's response
+            task = asyncio.create_task(self._send_batch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+    
+    async def _send_batch(self, batch: list):
+        # All callers share the service token; use the most recently queued
+        headers = batch[-1][1]
+        
+        try:
+            if len(batch) == 1:
+                results = [await send_hl7_to_emr(self.client, batch[0][0], headers)]
+            else:
+                # Each message starts with MSH, so CR-joining keeps them apart
+                body = "\r".join(hl7_message for hl7_message, _, _ in batch)
+                response = await send_hl7_to_emr(
+                    self.client, body, headers, self.batch_timeout(len(batch))
+                )
+                results = response["results"]
+                if len(results) != len(batch):
+                    raise ValueError(
+                        f"EMR returned {len(results)} results for {len(batch)} HL7 messages"
+                    )
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, _, future), result in zip(batch, results):
+            # Caller may have gone away (e.g. client disconnect)
+            if future.done():
+                continue
+            error = result.get("error")
+            if error:
+                future.set_exception(
+                    HTTPException(status_code=error["status_code"], detail=error["detail"])
+                )
+            else:
+                future.set_result(result)
+
+
+def format_date_for_hl7(date_str: str) -> str:
+    """
+    Convert MM/DD/YYYY to YYYYMMDD for HL7
     
-    # Generate message timestamp
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    PatientData.dob has already been pattern-checked, so the shape is not
+    re-validated here.
+    """
+    # Fast path: the zero-padded MM/DD/YYYY form clients normally send
+    if len(date_str) == 10:
+        return date_str[6:10] + date_str[0:2] + date_str[3:5]
     
-    # Generate unique message ID
-    msg_id = f"MSG{timestamp}"
+    # Unpadded months and days, e.g. 1/5/1990
+    month, day, year = date_str.split('/')
+    return year + month.zfill(2) + day.zfill(2)
+
+
+def get_hl7_header() -> Tuple[str, str]:
+    """
+    Current (timestamp, MSH segment) for outgoing messages
     
-    # MSH segment
-    msh = f"MSH|^~\\&|INTEGRATION|CLINIC|EMR|HOSPITAL|{timestamp}||ADT^A04|{msg_id}|P|2.5"
+    The timestamp is local time as YYYYMMDDHHMMSS and the message ID is
+    derived from it, so both are only rebuilt once per second.
+    """
+    global _hl7_header
+    second = int(time.time())
+    if _hl7_header[0] != second:
+        now = datetime.fromtimestamp(second)
+        timestamp = f"{now.year:04d}{now.month:02d}{now.day:02d}{now.hour:02d}{now.minute:02d}{now.second:02d}"
+        msh = f"MSH|^~\\&|INTEGRATION|CLINIC|EMR|HOSPITAL|{timestamp}||ADT^A04|MSG{timestamp}|P|2.5"
+        _hl7_header = (second, timestamp, msh)
+    return _hl7_header[1], _hl7_header[2]
+
+
+def generate_hl7_message(patient_data: PatientData) -> str:
+    """Generate HL7 ADT^A04 message from patient data"""
+    # Message timestamp and MSH segment (message ID is MSG + timestamp)
+    timestamp, msh = get_hl7_header()
     
     # PID segment
     mrn = patient_data.mrn if patient_data.mrn else f"MRN{timestamp}"
     last_name = patient_data.lastName
     first_name = patient_data.firstName
     dob = format_date_for_hl7(patient_data.dob)
-    gender = "M" if patient_data.gender.upper() in ["MALE", "M"] else "F"
+    gender = "M" if patient_data.gender.upper() in _MALE_VALUES else "F"
     
-    pid = f"PID|1||{mrn}^^^MRN||{last_name}^{first_name}||{dob}|{gender}"
+    # Segments are separated by CR (carriage return); building the message
+    # in one f-string avoids a segment list and join
+    hl7_message = f"{msh}\rPID|1||{mrn}^^^MRN||{last_name}^{first_name}||{dob}|{gender}"
     
     # IN1 segment (if insurance provided)
-    segments = [msh, pid]
-    
     if patient_data.insurance:
         ins = patient_data.insurance
-        in1 = f"IN1|1|{ins.memberID}||{ins.name}|||||{ins.groupNumber}|{ins.plan}"
-        segments.append(in1)
+        hl7_message = f"{hl7_message}\rIN1|1|{ins.memberID}||{ins.name}|||||{ins.groupNumber}|{ins.plan}"
     
-    # Join segments with CR (carriage return)
-    return "\r".join(segments)
+    return hl7_message
 
 
 @router.post("/")
-async def create_or_update_patient(patient_data: PatientData):
+async def create_or_update_patient(
+    patient_data: PatientData,
+    auth: IntegrationServiceAuth = Depends(get_auth),
+    client: httpx.AsyncClient = Depends(get_http),
+    hl7_sender: BatchSender = Depends(get_hl7_sender)
+):
     """
     Create or update patient in EMR
     
     Process:
     1. Get access token from EMR Server
     2. Check if patient exists (by MRN)
-    3. If not exists, generate HL7 message and send to EMR
+    3. If not exists, generate HL7 message and send to EMR (batched with
+       concurrent sends)
     4. Return result summary
     """
     # Get authentication token
     try:
-        token = await emr_auth.get_access_token()
+        await auth.get_access_token(client)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to authenticate: {str(e)}"
         )
     
+    # Headers prebuilt for the token just checked (no await in between)
+    auth_headers = auth.auth_headers
+    hl7_headers = auth.hl7_headers
+    
     # Check if patient exists
     existing_patient = None
     if patient_data.mrn:
-        existing_patient = await check_patient_exists(patient_data.mrn, token)
+        existing_patient = await find_patient_by_mrn(client, patient_data.mrn, auth_headers)
     
     if existing_patient:
         return {
@@ -209,12 +481,22 @@ async def create_or_update_patient(patient_data: PatientData):
     
     # Send HL7 to EMR
     try:
-        emr_response = await send_hl7_to_emr(hl7_message, token)
+        emr_response = await hl7_sender.send(hl7_message, hl7_headers)
+    except httpx.TimeoutException:
+        # The EMR may still finish creating the patient; a retry finds it
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="EMR Server did not respond in time; the patient may still have been created, retry to check"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to send to EMR: {str(e)}"
         )
+    finally:
+        # The patient may exist now, so drop any cached "not found"
+        if patient_data.mrn:
+            patient_cache.pop(patient_data.mrn, None)
     
     # Check if EMR found existing patient or created new one
     patient_action = emr_response.get("summary", {}).get("patient", {}).get("action")
@@ -0,0 +1,115 @@
+import asyncio
+import httpx
+import orjson
+from fastapi import HTTPException
+from emr_server.hl7_endpoint import HL7_BATCH_CONCURRENCY
+from integration_service.patient_service import (
+    BatchSender, EMR_HL7_BATCH_CONCURRENCY, HL7_BATCH_MAX_SIZE
+)
+
+
+class FakeEMR(httpx.AsyncBaseTransport):
+    """
+    Stand-in for POST /hl7/inbound that never actually sleeps
+
+    Like the real EMR, it answers a batch only once every message is done:
+    message_time per round of EMR_HL7_BATCH_CONCURRENCY messages. If that is
+    longer than the request's read timeout it raises ReadTimeout, as httpx
+    would, even though the patients were created.
+    """
+
+    def __init__(self, message_time: float, failing_mrns=()):
+        self.message_time = message_time
+        self.failing_mrns = set(failing_mrns)
+        self.requests = []  # (message count, read timeout)
+        self.created = []
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        pids = [line for line in request.content.decode().split("\r") if line.startswith("PID|")]
+        read_timeout = request.extensions["timeout"]["read"]
+        self.requests.append((len(pids), read_timeout))
+
+        results = []
+        for pid in pids:
+            mrn = pid.split("|")[3].split("^")[0]
+            if mrn in self.failing_mrns:
+                results.append({"error": {"status_code": 400, "detail": f"bad {mrn}"}})
+            else:
+                self.created.append(mrn)
+                results.append({"summary": {"patient": {"action": "created", "id": f"id-{mrn}"}}})
+
+        rounds = -(-len(pids) // EMR_HL7_BATCH_CONCURRENCY)
+        if self.message_time * rounds > read_timeout:
+            raise httpx.ReadTimeout("EMR did not answer in time", request=request)
+
+        body = results[0] if len(results) == 1 else {"results": results}
+        return httpx.Response(200, content=orjson.dumps(body))
+
+
+def hl7_message(mrn: str) -> str:
+    return f"MSH|^~\\&|INTEGRATION|CLINIC|EMR|HOSPITAL|20240101000000||ADT^A04|MSG{mrn}|P|2.5\rPID|1||{mrn}^^^MRN||Doe^Jane||19900101|F"
+
+
+async def send_all(emr: FakeEMR, mrns, **sender_options) -> list:
+    # Same default timeout as the Integration Service's shared client
+    client = httpx.AsyncClient(
+        transport=emr,
+        base_url="http://emr",
+        timeout=httpx.Timeout(connect=2.0, read=10.0, write=5.0, pool=5.0)
+    )
+    sender = BatchSender(client, **sender_options)
+    sender.start()
+    try:
+        return await asyncio.gather(
+            *(sender.send(hl7_message(mrn), {}) for mrn in mrns),
+            return_exceptions=True
+        )
+    finally:
+        await sender.stop()
+        await client.aclose()
+
+
+def test_batch_size_matches_emr_concurrency():
+    assert HL7_BATCH_MAX_SIZE <= HL7_BATCH_CONCURRENCY
+    assert EMR_HL7_BATCH_CONCURRENCY == HL7_BATCH_CONCURRENCY
+
+
+def test_slow_full_batch_does_not_time_out_created_patients():
+    # Each message takes longer than the client's 10s read timeout, but
+    # within a single message's budget
+    emr = FakeEMR(message_time=25.0)
+    mrns = [f"M{i}" for i in range(HL7_BATCH_MAX_SIZE)]
+
+    results = asyncio.run(send_all(emr, mrns))
+
+    assert [count for count, _ in emr.requests] == [HL7_BATCH_MAX_SIZE]
+    for mrn, result in zip(mrns, results):
+        assert result["summary"]["patient"]["id"] == f"id-{mrn}"
+
+
+def test_read_timeout_scales_with_emr_rounds():
+    emr = FakeEMR(message_time=25.0)
+    mrns = [f"M{i}" for i in range(2 * EMR_HL7_BATCH_CONCURRENCY)]
+
+    results = asyncio.run(send_all(emr, mrns, max_batch_size=len(mrns)))
+
+    assert emr.requests == [(len(mrns), 60.0)]
+    assert not [result for result in results if isinstance(result, Exception)]
+
+
+def test_failed_message_only_fails_its_caller():
+    emr = FakeEMR(message_time=0.1, failing_mrns={"BAD"})
+    mrns = ["M1", "BAD", "M2"]
+
+    ok_1, bad, ok_2 = asyncio.run(send_all(emr, mrns))
+
+    assert ok_1["summary"]["patient"]["id"] == "id-M1"
+    assert ok_2["summary"]["patient"]["id"] == "id-M2"
+    assert isinstance(bad, HTTPException) and bad.status_code == 400
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
\ No newline at end of file